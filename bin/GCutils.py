@@ -7,6 +7,7 @@ from ete3 import TreeNode, NodeStyle, TreeStyle, TextFace, CircleFace, PieChartF
 import scipy
 import numpy as np
 import random
+import re
 try:
     import cPickle as pickle
 except:
@@ -21,9 +22,12 @@ try:
             return jellyfish.hamming_distance(unicode(s1), unicode(s2))
 except:
     def hamming_distance(seq1, seq2):
-        '''Hamming distance between two sequences of equal length'''
-        return sum(x != y for x, y in zip(seq1, seq2))
-    print('Couldn\'t find the python module "jellyfish" which is used for fast string comparison. Falling back to pure python function.')
+        '''Hamming distance between two sequences of equal length, compared byte-wise by numpy'''
+        seq1 = np.frombuffer(str(seq1).encode(), dtype=np.uint8)
+        seq2 = np.frombuffer(str(seq2).encode(), dtype=np.uint8)
+        n = min(len(seq1), len(seq2))
+        return int((seq1[:n] != seq2[:n]).sum())
+    print('Couldn\'t find the python module "jellyfish" which is used for fast string comparison. Falling back to a numpy function.')
 
 global ISO_TYPE_ORDER
 global ISO_TYPE_charORDER
@@ -32,14 +36,38 @@ ISO_TYPE_ORDER = {'IgM': 1, 'IgD': 1, 'IgG': 2, 'IgGA': 2, 'IgGb': 2, 'IgE': 3,
 ISO_TYPE_charORDER = {'M': 1, 'D': 2, 'G': 3, 'E': 4, 'A': 5}
 ISO_SHORT = {'IgM': 'M', 'IgD': 'D', 'IgG': 'G', 'IgGA': 'G', 'IgGb': 'G', 'IgE': 'E', 'IgA': 'A'}
 
-def translate(seq):
+def translate(seq, frame=None):
+    if frame is not None:
+        # trim to whole codons in the given frame
+        seq = seq[(frame-1):(frame-1+(3*(((len(seq)-(frame-1))//3))))]
     return str(Seq(seq[:], generic_dna).translate())
 
 
+def cached_translator(frame=None):
+    '''
+    Return a translate function caching its results,
+    when rendering every sequence with children is translated again as a parent.
+    '''
+    translations = dict()
+    def cached_translate(seq):
+        if seq not in translations:
+            translations[seq] = translate(seq, frame)
+        return translations[seq]
+    return cached_translate
+
+
 def has_stop(seq):
     return '*' in str(Seq(seq[:], generic_dna).translate())
 
 
+global NON_ACGT
+NON_ACGT = re.compile('[^ACGT]', re.IGNORECASE)
+
+def is_unambiguous(seq):
+    '''True if seq holds only unambiguous bases (A, C, G or T), checked in a single regex scan.'''
+    return NON_ACGT.search(seq) is None
+
+
 class CollapsedTree():
     '''
     Collapsed tree class from GCtree. Collapses an ete3 tree
@@ -102,11 +130,11 @@ class CollapsedTree():
             raise RuntimeError('observed genotypes don\'t match after collapse\n\tbefore: {}\n\tafter: {}\n\tsymmetric diff: {}'.format(observed_genotypes, final_observed_genotypes, observed_genotypes ^ final_observed_genotypes))
         assert sum(node.frequency for node in tree.traverse()) == sum(node.frequency for node in self.tree.traverse())
 
-        rep_seq = sum(node.frequency > 0 for node in self.tree.traverse()) - len(set([node.sequence for node in self.tree.traverse() if node.frequency > 0]))
+        observed_sequences = [node.sequence for node in self.tree.traverse() if node.frequency > 0]
+        rep_seq = len(observed_sequences) - len(set(observed_sequences))
         if not allow_repeats and rep_seq:
             raise RuntimeError('Repeated observed sequences in collapsed tree. {} sequences were found repeated.'.format(rep_seq))
         elif allow_repeats and rep_seq:
-            rep_seq = sum(node.frequency > 0 for node in self.tree.traverse()) - len(set([node.sequence for node in self.tree.traverse() if node.frequency > 0]))
             print('Repeated observed sequences in collapsed tree. {} sequences were found repeated.'.format(rep_seq))
         # a custom ladderize accounting for abundance and sequence to break ties in abundance
         for node in self.tree.traverse(strategy='postorder'):
@@ -194,13 +222,14 @@ class CollapsedTree():
                 C.rotation = -90
                 C.hz_align = 1
                 faces.add_face_to_node(C, node, 0)
+        cached_translate = cached_translator()
         for node in self.tree.traverse():
             nstyle = NodeStyle()
             nstyle['size'] = 0
             if node.up is not None:
-                if set(node.sequence.upper()) == set('ACGT'):  # Don't know what this do, try and delete
-                    aa = translate(node.sequence)
-                    aa_parent = translate(node.up.sequence)
+                if is_unambiguous(node.sequence):  # Ambiguous sequences cannot be translated reliably
+                    aa = cached_translate(node.sequence)
+                    aa_parent = cached_translate(node.up.sequence)
                     nonsyn = hamming_distance(aa, aa_parent)
                     if '*' in aa:
                         nstyle['bgcolor'] = 'red'
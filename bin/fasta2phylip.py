@@ -117,7 +117,7 @@ def main():
             for seq_id, cell_ids in id_map.items():
                 print('{},{}'.format(seq_id, ':'.join(cell_ids)), file=f)
         with open(args.idmapfile+'_idmap.p', 'wb') as f:
-            runstats = pickle.dump(id_map, f)
+            pickle.dump(id_map, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 if __name__ == '__main__':
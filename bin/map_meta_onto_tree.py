@@ -11,58 +11,146 @@ import GCutils
 from GCutils import CollapsedTree, CollapsedForest, hamming_distance
 from COAR import COAR
 try:
-    import cPickle as pickle
-except:
+    import cPickle as pickle  # Python 2: plain pickle is the pure Python implementation
+except ImportError:
     import pickle
 import os, sys
+import multiprocessing
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2: intern is a builtin
 
 global ISO_TYPE_ORDER
 ISO_TYPE_ORDER = [set(['IgM', 'IgD']), set(['IgG', 'IgGA', 'IgGb']), set(['IgE']), set(['IgA'])]
 global ALL_ISO_TYPE
 ALL_ISO_TYPE = set(['IgM', 'IgD', 'IgG', 'IgGA', 'IgGb', 'IgE', 'IgA'])
+global ISO_BIT
+ISO_BIT = {iso: 1 << i for i, iso in enumerate(sorted(ALL_ISO_TYPE))}  # one bit per isotype
+global IO_BUFFER_SIZE
+IO_BUFFER_SIZE = 2**18  # 256 KiB, the forest pickles are easily several MB
 
-def map_meta(args):
-    # Read trees:
-    tree_dict = dict()
-    for forest_file in args.forest_files:
-        with open(forest_file, 'rb') as f:
-            forest = pickle.load(f)
-            tree_dict[forest_file] = forest
+def encode_isotypes(iso_set):
+    '''Encode a collection of isotypes as a bit mask, unions of isotypes are then just bitwise ORs.'''
+    assert(set(iso_set) <= ALL_ISO_TYPE)  # All isotypes must be in the known set
+    mask = 0
+    for iso in iso_set:
+        mask |= ISO_BIT[iso]
+    return mask
+
+
+def decode_isotypes(mask):
+    '''Decode an isotype bit mask back into a set of isotypes.'''
+    return set(iso for iso, bit in ISO_BIT.items() if mask & bit)
+
+
+def summarize_meta(names, compact):
+    '''
+    Reduce the meta information of the sequences collapsed into one node to (abundance, isotypes, chain, name),
+    the node is named after its first sequence with the _heavy or _light suffix trimmed off.
+    '''
+    assert(names)
+    abundance = 0
+    iso_mask = 0
+    chain = compact[names[0]][2]
+    for name in names:
+        name_abundance, name_iso_mask, _ = compact[name]
+        abundance += name_abundance
+        iso_mask |= name_iso_mask
+    # All sequences collapsed into a node must come from the same chain:
+    assert(all(compact[name][2] == chain for name in names))
+    return abundance, frozenset(decode_isotypes(iso_mask)), chain, names[0][:-6]
+
+
+def map_meta_forest(fnam, compact, id_map, summaries=None):
+    '''
+    Annotate the forest pickled in fnam with meta information and dump it next to the input with a _meta suffix.
+    summaries caches the reduced meta information per id_map entry, the same sequences recur in every
+    tree of a forest and in every forest inferred from the same data, so it can be shared between calls.
+    '''
+    if summaries is None:
+        summaries = dict()
+    with open(fnam, 'rb', IO_BUFFER_SIZE) as f:
+        data = f.read()
+    forest = pickle.loads(data)
+    del data
+    meta_features = ('isotype', 'chain')
+    # Only observed nodes carry meta information, collect them from all trees in the forest at once:
+    observed = [node for tree in forest.forest for node in tree.tree.traverse() if node.frequency > 0]
+    for node in observed:
+        seq_id = node.name
+        if seq_id not in summaries:
+            summaries[seq_id] = summarize_meta(id_map[seq_id], compact)
+        abundance, iso_set, chain, name = summaries[seq_id]
+        iso_set = set(iso_set)
+        # IgM at the root:
+        if node.up is None:
+            iso_set.add('IgM')
+        node.frequency += abundance - 1  # No double counting if seen just once
+        # Same as add_feature, without a method call per feature:
+        node.isotype = iso_set
+        node.chain = chain
+        node.features.update(meta_features)
+        node.name = name
+    forest.forest[0].render(fnam[:-2] + '_meta.svg', isolabel=True)
+    # Write to a temporary file and rename it into place, so a crash never leaves a truncated forest behind:
+    outfile = fnam[:-2] + '_meta' + fnam[-2:]
+    tmpfile = outfile + '.tmp'
+    try:
+        with open(tmpfile, 'wb', IO_BUFFER_SIZE) as f:
+            pickle.dump(forest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except:
+        # Don't leave a partial dump behind, the error is re-raised:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.rename(tmpfile, outfile)
 
+
+# Lookup tables shared with the worker processes, set once per worker by the pool initializer:
+_worker_tables = None
+
+def _init_worker(compact, id_map):
+    global _worker_tables
+    _worker_tables = (compact, id_map, dict())
+
+
+def _map_meta_worker(fnam):
+    map_meta_forest(fnam, *_worker_tables)
+
+
+def map_meta(args):
     # Read meta info:
-    with open(args.meta, 'rb') as f:
-        seq_info_dict = pickle.load(f)
+    with open(args.meta, 'rb', IO_BUFFER_SIZE) as f:
+        data = f.read()
+    seq_info_dict = pickle.loads(data)
     # Read idmap:
-    with open(args.idmap, 'rb') as fh:
-            id_map = pickle.load(fh)
-    # Map meta information:
-    for fnam, forest in tree_dict.items():
-        for tree in forest.forest:
-            for node in tree.tree.traverse():
-                if node.frequency > 0:
-                    assert(len(id_map[node.name]) > 0)
-                    abundance = 0
-                    iso_set = set()
-                    chain = None
-                    for name in id_map[node.name]:
-                        meta = seq_info_dict[name]
-                        abundance += meta['abundance']
-                        iso_set |= set(meta['iso_set'])
-                        assert(iso_set & ALL_ISO_TYPE == iso_set)  # All isotypes must be in the known set
-                        if chain is None:
-                            chain = meta['chain']
-                        else:
-                            assert(meta['chain'] == chain)
-                    # IgM at the root:
-                    if node.up is None:
-                        iso_set |= set(['IgM'])
-                    node.frequency += abundance - 1  # No double counting if seen just once
-                    node.add_feature('isotype', iso_set)
-                    node.add_feature('chain', chain)
-                    node.name = name[:-6]  # trim off _heavy or _light from the name
-        forest.forest[0].render(fnam[:-2] + '_meta.svg', isolabel=True)
-        with open(fnam[:-2]+'_meta'+fnam[-2:], 'wb') as f:
-            pickle.dump(forest, f)
+    with open(args.idmap, 'rb', IO_BUFFER_SIZE) as fh:
+        data = fh.read()
+    id_map = pickle.loads(data)
+    del data
+    # The name lists are only ever iterated, tuples are smaller and faster to iterate.
+    # Names are interned so lookups between the two dicts, loaded from separate pickles, compare by identity:
+    id_map = {intern(seq_id): tuple(intern(name) for name in names) for seq_id, names in id_map.items()}
+    # Flatten the meta information needed per sequence into a single tuple lookup,
+    # only for the sequences the id map refers to (e.g. the naive is left out of its own entry):
+    mapped_names = set(name for names in id_map.values() for name in names)
+    compact = {name: (seq_info_dict[name]['abundance'], encode_isotypes(seq_info_dict[name]['iso_set']), seq_info_dict[name]['chain']) for name in mapped_names}
+    del seq_info_dict
+    # Map meta information, one forest at a time to keep only a single forest in memory per process.
+    # The forest files are independent, so they can be spread over several processes:
+    nproc = min(args.nproc, len(args.forest_files))
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=_init_worker, initargs=(compact, id_map))
+        try:
+            pool.map(_map_meta_worker, args.forest_files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summaries = dict()
+        for fnam in args.forest_files:
+            map_meta_forest(fnam, compact, id_map, summaries)
 
 
 def main():
@@ -74,6 +162,7 @@ def main():
     parser.add_argument('--meta', type=str, help='Path to .p dict containing meta information.')
     parser.add_argument('--idmap', type=str, help='Path to .p dict containing ID map.')
     parser.add_argument('--forest_files', type=str, nargs='*', help='Paths to .p tree files')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of processes to spread the forest files over.')
     args = parser.parse_args()
     map_meta(args)
 
@@ -49,7 +49,8 @@ def iter_edges(fh):
 # iterate over entries in the sequences section
 def parse_seqdict(fh, mode='dnaml'):
     #  152        sssssssssG AGGTGCAGCT GTTGGAGTCT GGGGGAGGCT TGGTACAGCC TGGGGGGTCC
-    seqs = defaultdict(str)
+    # sequences are interleaved over several blocks, collect the chunks and join them once at the end
+    seqs = defaultdict(list)
     if mode == 'dnaml':
         patterns = re.compile("^\s*(?P<id>[a-zA-Z0-9>_.-]*)\s+(?P<seq>[a-zA-Z \-]+)")
     elif mode == 'dnapars':
@@ -59,9 +60,9 @@ def parse_seqdict(fh, mode='dnaml'):
     fh.next()
     for line in fh:
         m = patterns.match(line)
-        if m and m.group("id") is not '':
+        if m and m.group("id") != '':
             last_blank = False
-            seqs[m.group("id")] += m.group("seq").replace(" ", "").upper()
+            seqs[m.group("id")].append(m.group("seq").replace(" ", "").upper())
         elif line.rstrip() == '':
             if last_blank:
                 break
@@ -70,7 +71,7 @@ def parse_seqdict(fh, mode='dnaml'):
                 continue
         else:
             break
-    return seqs
+    return {seq_id: ''.join(chunks) for seq_id, chunks in seqs.items()}
 
 
 # parse the dnaml output file and return data structures containing a
@@ -79,7 +80,11 @@ def parse_seqdict(fh, mode='dnaml'):
 def parse_outfile(outfile, countfile=None, naive='naive'):
     '''parse phylip outfile'''
     if countfile is not None:
-        counts = {l.split(',')[0]:int(l.split(',')[1]) for l in open(countfile)}
+        counts = dict()
+        with open(countfile) as fh:
+            for l in fh:
+                fields = l.split(',')
+                counts[fields[0]] = int(fields[1])
     # No count, just make an empty count dictionary:
     else:
         counts = None
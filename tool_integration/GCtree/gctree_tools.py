@@ -35,7 +35,7 @@ import phylip_parse
 #from bin.GCutils import hamming_distance
 #from bin.GCutils import CollapsedForest as newCollapsedForest
 #from bin.GCutils import CollapsedTree as newCollapsedTree
-from GCutils import hamming_distance
+from GCutils import hamming_distance, is_unambiguous, cached_translator
 from GCutils import CollapsedForest as newCollapsedForest
 from GCutils import CollapsedTree as newCollapsedTree
 
@@ -44,6 +44,132 @@ from GCutils import CollapsedTree as newCollapsedTree
 scipy.seterr(all='raise')
 
 
+_f_hash = {}  # <--- module level cache of calls to the following function
+def _f(p, q, c, m):
+    '''
+    Recursion behind LeavesAndClades.f, memoized on (p, q, c, m).
+    Recursing on plain integers avoids building a LeavesAndClades instance for every neighbor.
+    Returns plain floats (f, df/dp, df/dq), the gradient array is only built by LeavesAndClades.f
+    '''
+    if (p, q, c, m) not in _f_hash:
+        if c==m==0 or (c==0 and m==1):
+            f_result = 0
+            dfdp_result = 0
+            dfdq_result = 0
+        elif c==1 and m==0:
+            f_result = 1-p
+            dfdp_result = -1
+            dfdq_result = 0
+        elif c==0 and m==2:
+            f_result = p*q**2
+            dfdp_result = q**2
+            dfdq_result = 2*p*q
+        else:
+            if m >= 1:
+                neighbor_f, neighbor_dfdp, neighbor_dfdq = _f(p, q, c, m-1)
+                f_result = 2*p*q*(1-q)*neighbor_f
+                dfdp_result =   2*q*(1-q) * neighbor_f + \
+                              2*p*q*(1-q) * neighbor_dfdp
+                dfdq_result = (2*p - 4*p*q) * neighbor_f + \
+                               2*p*q*(1-q)  * neighbor_dfdq
+            else:
+                f_result = 0.
+                dfdp_result = 0.
+                dfdq_result = 0.
+            for cx in range(c+1):
+                for mx in range(m+1):
+                    if (not (cx==0 and mx==0)) and (not (cx==c and mx==m)):
+                        neighbor1_f, neighbor1_dfdp, neighbor1_dfdq = _f(p, q, cx, mx)
+                        neighbor2_f, neighbor2_dfdp, neighbor2_dfdq = _f(p, q, c-cx, m-mx)
+                        f_result += p*(1-q)**2*neighbor1_f*neighbor2_f
+                        dfdp_result +=   (1-q)**2 * neighbor1_f    * neighbor2_f + \
+                                       p*(1-q)**2 * neighbor1_dfdp * neighbor2_f + \
+                                       p*(1-q)**2 * neighbor1_f    * neighbor2_dfdp
+                        dfdq_result += -2*p*(1-q) * neighbor1_f    * neighbor2_f + \
+                                       p*(1-q)**2 * neighbor1_dfdq * neighbor2_f + \
+                                       p*(1-q)**2 * neighbor1_f    * neighbor2_dfdq
+        _f_hash[(p, q, c, m)] = (f_result, dfdp_result, dfdq_result)
+    return _f_hash[(p, q, c, m)]
+
+
+_f_hot = None  # <--- (p, q, f, df/dp, df/dq) of the last table filled by _f_table
+def _f_table(p, q, C, M):
+    '''
+    Bottom-up version of _f, filling in f and its gradient wrt (p, q) for all 0 <= c <= C and 0 <= m <= M at once.
+    Each cell only depends on cells with smaller or equal c and m, so one pass over m, then c, fills the table
+    without recursion or hashing.
+    Returns three (C+1) x (M+1) arrays: f, df/dp and df/dq
+    The last table filled is kept in _f_hot, and a request for the same (p, q) that it covers (e.g. check_grad
+    evaluating the likelihood and its gradient separately) is answered by slicing it, without refilling.
+    The returned arrays are shared with that cache and therefore read-only.
+    '''
+    global _f_hot
+    C, M = int(C), int(M)
+    if _f_hot is not None and _f_hot[:2] == (p, q) and C < _f_hot[2].shape[0] and M < _f_hot[2].shape[1]:
+        return tuple(table[:C+1, :M+1] for table in _f_hot[2:])
+    # coefficients of the recurrence, constant for given (p, q):
+    omq = 1 - q
+    omq2 = omq*omq
+    mut = 2*p*q*omq             # one mutant and one clone child
+    dmut_dp = 2*q*omq
+    dmut_dq = 2*p - 4*p*q
+    clone = p*omq2              # two clone children
+    dclone_dp = omq2
+    dclone_dq = -2*p*omq
+    f = [[0.]*(M+1) for _ in range(C+1)]
+    dfdp = [[0.]*(M+1) for _ in range(C+1)]
+    dfdq = [[0.]*(M+1) for _ in range(C+1)]
+    for m in range(M+1):
+        for c in range(C+1):
+            if c==m==0 or (c==0 and m==1):
+                continue
+            elif c==1 and m==0:
+                f[c][m] = 1-p
+                dfdp[c][m] = -1.
+                dfdq[c][m] = 0.
+            elif c==0 and m==2:
+                f[c][m] = p*q*q
+                dfdp[c][m] = q*q
+                dfdq[c][m] = 2*p*q
+            else:
+                # one mutant and one clone child, the clone continuing as (c, m-1); nothing to add when m == 0
+                neighbor_f, neighbor_dfdp, neighbor_dfdq = (f[c][m-1], dfdp[c][m-1], dfdq[c][m-1]) if m else (0., 0., 0.)
+                f_result = mut*neighbor_f
+                dfdp_result = dmut_dp*neighbor_f + mut*neighbor_dfdp
+                dfdq_result = dmut_dq*neighbor_f + mut*neighbor_dfdq
+                # two clone children splitting (c, m) between them, neither of them empty (0, 0).
+                # The terms are symmetric in the two children, so only the splits with (cx, mx) lexicographically
+                # below (c-cx, m-mx) are summed and doubled, and the even split (c/2, m/2), if any, is added once.
+                # The loop bounds skip (cx, mx) = (0, 0) and (c, m) instead of testing every pair.
+                neighbors_f = neighbors_dfdp = neighbors_dfdq = 0.
+                for cx in range(c//2 + 1):
+                    for mx in range(1 if cx == 0 else 0, m+1 if 2*cx < c else (m+1)//2):
+                        neighbor1_f, neighbor1_dfdp, neighbor1_dfdq = f[cx][mx], dfdp[cx][mx], dfdq[cx][mx]
+                        neighbor2_f, neighbor2_dfdp, neighbor2_dfdq = f[c-cx][m-mx], dfdp[c-cx][m-mx], dfdq[c-cx][m-mx]
+                        neighbors_f += neighbor1_f*neighbor2_f
+                        neighbors_dfdp += neighbor1_dfdp*neighbor2_f + neighbor1_f*neighbor2_dfdp
+                        neighbors_dfdq += neighbor1_dfdq*neighbor2_f + neighbor1_f*neighbor2_dfdq
+                neighbors_f *= 2
+                neighbors_dfdp *= 2
+                neighbors_dfdq *= 2
+                if c % 2 == 0 and m % 2 == 0:
+                    half_f, half_dfdp, half_dfdq = f[c//2][m//2], dfdp[c//2][m//2], dfdq[c//2][m//2]
+                    neighbors_f += half_f*half_f
+                    neighbors_dfdp += 2*half_dfdp*half_f
+                    neighbors_dfdq += 2*half_dfdq*half_f
+                f_result += clone*neighbors_f
+                dfdp_result += dclone_dp*neighbors_f + clone*neighbors_dfdp
+                dfdq_result += dclone_dq*neighbors_f + clone*neighbors_dfdq
+                f[c][m] = f_result
+                dfdp[c][m] = dfdp_result
+                dfdq[c][m] = dfdq_result
+    f, dfdp, dfdq = scipy.array(f), scipy.array(dfdp), scipy.array(dfdq)
+    for table in (f, dfdp, dfdq):
+        table.flags.writeable = False
+    _f_hot = (p, q, f, dfdp, dfdq)
+    return f, dfdp, dfdq
+
+
 class LeavesAndClades():
     '''
     This is a base class for simulating, and computing likelihood for, an infinite type branching
@@ -82,10 +208,16 @@ class LeavesAndClades():
         len_tree = 0
         self.c = 0
         self.m = 0
+        # the number of mutant children of a branching node is binomial(2, q), drawn with a single uniform
+        # against the thresholds P(2 mutants) = q^2 and P(at least 1 mutant) = 1 - (1-q)^2
+        p, q = self.params
+        two_mutants = q*q
+        any_mutants = 1 - (1-q)**2
         # while termination condition not met
         while cumsum_clones > len_tree - 1:
-            if random.random() < self.params[0]:
-                mutants = sum(random.random() < self.params[1] for child in range(2))
+            if random.random() < p:
+                u = random.random()
+                mutants = 2 if u < two_mutants else 1 if u < any_mutants else 0
                 clones = 2 - mutants
                 self.m += mutants
             else:
@@ -96,7 +228,7 @@ class LeavesAndClades():
             len_tree += 1
         assert cumsum_clones == len_tree - 1
 
-    f_hash = {} # <--- class variable for hashing calls to the following function
+    f_hash = _f_hash  # <--- class level alias of the module level cache of _f
     def f(self, params):
         '''
         Probability of getting c leaves that are clones of the root and m mutant clades off
@@ -105,49 +237,8 @@ class LeavesAndClades():
         Computed by dynamic programming
         '''
         p, q = params
-        c, m = self.c, self.m
-        if (p, q, c, m) not in LeavesAndClades.f_hash:
-            if c==m==0 or (c==0 and m==1):
-                f_result = 0
-                dfdp_result = 0
-                dfdq_result = 0
-            elif c==1 and m==0:
-                f_result = 1-p
-                dfdp_result = -1
-                dfdq_result = 0
-            elif c==0 and m==2:
-                f_result = p*q**2
-                dfdp_result = q**2
-                dfdq_result = 2*p*q
-            else:
-                if m >= 1:
-                    neighbor = LeavesAndClades(params=params, c=c, m=m-1)
-                    neighbor_f, (neighbor_dfdp, neighbor_dfdq) = neighbor.f(params)
-                    f_result = 2*p*q*(1-q)*neighbor_f
-                    dfdp_result =   2*q*(1-q) * neighbor_f + \
-                                  2*p*q*(1-q) * neighbor_dfdp
-                    dfdq_result = (2*p - 4*p*q) * neighbor_f + \
-                                   2*p*q*(1-q)  * neighbor_dfdq
-                else:
-                    f_result = 0.
-                    dfdp_result = 0.
-                    dfdq_result = 0.
-                for cx in range(c+1):
-                    for mx in range(m+1):
-                        if (not (cx==0 and mx==0)) and (not (cx==c and mx==m)):
-                            neighbor1 = LeavesAndClades(params=params, c=cx, m=mx)
-                            neighbor2 = LeavesAndClades(params=params, c=c-cx, m=m-mx)
-                            neighbor1_f, (neighbor1_dfdp, neighbor1_dfdq) = neighbor1.f(params)
-                            neighbor2_f, (neighbor2_dfdp, neighbor2_dfdq) = neighbor2.f(params)
-                            f_result += p*(1-q)**2*neighbor1_f*neighbor2_f
-                            dfdp_result +=   (1-q)**2 * neighbor1_f    * neighbor2_f + \
-                                           p*(1-q)**2 * neighbor1_dfdp * neighbor2_f + \
-                                           p*(1-q)**2 * neighbor1_f    * neighbor2_dfdp
-                            dfdq_result += -2*p*(1-q) * neighbor1_f    * neighbor2_f + \
-                                           p*(1-q)**2 * neighbor1_dfdq * neighbor2_f + \
-                                           p*(1-q)**2 * neighbor1_f    * neighbor2_dfdq
-            LeavesAndClades.f_hash[(p, q, c, m)] = (f_result, scipy.array([dfdp_result, dfdq_result]))
-        return LeavesAndClades.f_hash[(p, q, c, m)]
+        f_result, dfdp_result, dfdq_result = _f(p, q, self.c, self.m)
+        return f_result, scipy.array([dfdp_result, dfdq_result])
 
 
 class CollapsedTree(LeavesAndClades):
@@ -215,11 +306,11 @@ class CollapsedTree(LeavesAndClades):
                 raise RuntimeError('observed genotypes don\'t match after collapse\n\tbefore: {}\n\tafter: {}\n\tsymmetric diff: {}'.format(observed_genotypes, final_observed_genotypes, observed_genotypes ^ final_observed_genotypes))
             assert sum(node.frequency for node in tree.traverse()) == sum(node.frequency for node in self.tree.traverse())
 
-            rep_seq = sum(node.frequency > 0 for node in self.tree.traverse()) - len(set([node.sequence for node in self.tree.traverse() if node.frequency > 0]))
+            observed_sequences = [node.sequence for node in self.tree.traverse() if node.frequency > 0]
+            rep_seq = len(observed_sequences) - len(set(observed_sequences))
             if not allow_repeats and rep_seq:
                 raise RuntimeError('Repeated observed sequences in collapsed tree. {} sequences were found repeated.'.format(rep_seq))
             elif allow_repeats and rep_seq:
-                rep_seq = sum(node.frequency > 0 for node in self.tree.traverse()) - len(set([node.sequence for node in self.tree.traverse() if node.frequency > 0]))
                 print('Repeated observed sequences in collapsed tree. {} sequences were found repeated.'.format(rep_seq))
             # a custom ladderize accounting for abundance and sequence to break ties in abundance
             for node in self.tree.traverse(strategy='postorder'):
@@ -229,6 +320,13 @@ class CollapsedTree(LeavesAndClades):
                 node.children.sort(key=lambda node: (node.partition, node.sequence))
         else:
             self.tree = tree
+        self._leaves_and_clades = None  # <--- computed on first use by leaves_and_clades
+
+    def __getstate__(self):
+        '''pickle without the cached leaves and clades, they are recomputed from the tree on first use'''
+        state = self.__dict__.copy()
+        state.pop('_leaves_and_clades', None)
+        return state
 
     def l(self, params, sign=1):
         '''
@@ -239,17 +337,42 @@ class CollapsedTree(LeavesAndClades):
             raise ValueError('tree data must be defined to compute likelihood')
         if sign not in (-1, 1):
             raise ValueError('sign must be 1 or -1')
-        leaves_and_clades_list = [LeavesAndClades(c=node.frequency, m=len(node.children)) for node in self.tree.traverse()]
-        if leaves_and_clades_list[0].c == 0 and leaves_and_clades_list[0].m == 1 and leaves_and_clades_list[0].f(params)[0] == 0:
+        p, q = params
+        c, m = self.leaves_and_clades()
+        # fill the table of f values once for all nodes
+        f_tables = _f_table(p, q, max(c.max(), 1), m.max())
+        logf, grad_logf = self._l_from_tables(f_tables, c, m)
+        return sign*logf, sign*grad_logf
+
+    @staticmethod
+    def _l_from_tables(f_tables, c, m):
+        '''
+        log likelihood and its gradient for a tree with clone leaves c and mutant clades m per node (root first),
+        given the (f, df/dp, df/dq) tables from _f_table covering all of them
+        '''
+        f_table, dfdp_table, dfdq_table = f_tables
+        if c[0] == 0 and m[0] == 1 and f_table[0, 1] == 0:
             # if unifurcation not possible under current model, add a psuedocount for the naive
-            leaves_and_clades_list[0].c = 1
-        # extract vector of function values and gradient components
-        f_data = [leaves_and_clades.f(params) for leaves_and_clades in leaves_and_clades_list]
-        fs = scipy.array([[x[0]] for x in f_data])
+            c = c.copy()
+            c[0] = 1
+        # gather vector of function values and gradient components
+        fs = f_table[c, m]
         logf = scipy.log(fs).sum()
-        grad_fs = scipy.array([x[1] for x in f_data])
-        grad_logf = (grad_fs/fs).sum(axis=0)
-        return sign*logf, sign*grad_logf
+        grad_logf = scipy.array([(dfdp_table[c, m]/fs).sum(), (dfdq_table[c, m]/fs).sum()])
+        return logf, grad_logf
+
+    def leaves_and_clades(self):
+        '''
+        number of clone leaves, c, and mutant clades, m, of every node in the tree (root first) as two integer arrays
+        these only depend on the tree, not on params, so they are cached once computed
+        __init__ and simulate reset the cache when they set the tree, set _leaves_and_clades to None after
+        modifying the tree in any other way
+        '''
+        if getattr(self, '_leaves_and_clades', None) is None:
+            c = scipy.array([node.frequency for node in self.tree.traverse()], dtype=int)
+            m = scipy.array([len(node.children) for node in self.tree.traverse()], dtype=int)
+            self._leaves_and_clades = (c, m)
+        return self._leaves_and_clades
 
     def mle(self, **kwargs):
         '''
@@ -284,6 +407,7 @@ class CollapsedTree(LeavesAndClades):
         # in the root node of the collapsed tree
         LeavesAndClades.simulate(self)
         self.tree = TreeNode()
+        self._leaves_and_clades = None
         self.tree.add_feature('frequency', self.c)
         if self.m == 0:
             return self
@@ -321,11 +445,12 @@ class CollapsedTree(LeavesAndClades):
                 T.rotation = -90
                 T.hz_align = 1
                 faces.add_face_to_node(T, node, 1 if isinstance(circle_color, str) else 2, position='branch-right')
+        translate_frame = cached_translator(self.frame)
         for node in self.tree.traverse():
             nstyle = NodeStyle()
             nstyle['size'] = 0
             if node.up is not None:
-                if set(node.sequence.upper()) == set('ACGT'):
+                if is_unambiguous(node.sequence):
                     if chain_split is not None:
                         if self.frame is not None:
                             raise NotImplementedError('frame not implemented with chain_split')
@@ -341,10 +466,8 @@ class CollapsedTree(LeavesAndClades):
                             nstyle['hz_line_color'] = 'blue'
                             nstyle['hz_line_width'] = 2
                     if self.frame is not None:
-                        aa = Seq(node.sequence[(self.frame-1):(self.frame-1+(3*(((len(node.sequence)-(self.frame-1))//3))))],
-                                 generic_dna).translate()
-                        aa_parent = Seq(node.up.sequence[(self.frame-1):(self.frame-1+(3*(((len(node.sequence)-(self.frame-1))//3))))],
-                                        generic_dna).translate()
+                        aa = translate_frame(node.sequence)
+                        aa_parent = translate_frame(node.up.sequence)
                         nonsyn = hamming_distance(aa, aa_parent)
                         if '*' in aa:
                             nstyle['bgcolor'] = 'red'
@@ -538,21 +661,23 @@ class CollapsedForest(CollapsedTree):
             raise ValueError('forest data must be defined to compute likelihood')
         if sign not in (-1, 1):
             raise ValueError('sign must be 1 or -1')
-        # since the l method on the CollapsedTree class returns l and grad_l...
-        terms = [tree.l(params) for tree in self.forest]
+        # fill the table of f values once for the whole forest, rather than once per tree
+        p, q = params
+        leaves_and_clades = [tree.leaves_and_clades() for tree in self.forest]
+        f_tables = _f_table(p, q,
+                            max(max(c.max() for c, m in leaves_and_clades), 1),
+                            max(m.max() for c, m in leaves_and_clades))
+        # l and grad_l of each tree, as the l method on the CollapsedTree class would return them...
+        terms = [self._l_from_tables(f_tables, c, m) for c, m in leaves_and_clades]
         ls = scipy.array([term[0] for term in terms])
         grad_ls = scipy.array([term[1] for term in terms])
         if empirical_bayes_sum:
-            # we need to find the smallest derivative component for each
-            # coordinate, then subtract off to get positive things to logsumexp
-            grad_l = []
-            for j in range(len(params)):
-                i_prime = grad_ls[:,j].argmin()
-                grad_l.append(grad_ls[i_prime,j] +
-                              scipy.exp(logsumexp(ls - ls[i_prime],
-                                                  b=grad_ls[:,j]-grad_ls[i_prime,j]) -
-                                        logsumexp(ls - ls[i_prime])))
-            return sign*(-scipy.log(len(ls)) + logsumexp(ls)), sign*scipy.array(grad_l)
+            # the gradient of the log mean likelihood is the mean of the tree gradients weighted by
+            # their likelihoods, i.e. by the softmax of the log likelihoods, which is stable via logsumexp
+            logsumexp_ls = logsumexp(ls)
+            with scipy.errstate(under='ignore'):  # negligible trees may underflow to zero weight
+                weights = scipy.exp(ls - logsumexp_ls)
+            return sign*(-scipy.log(len(ls)) + logsumexp_ls), sign*weights.dot(grad_ls)
         else:
             return sign*ls.sum(), sign*grad_ls.sum(axis=0)
 